@@ -6,17 +6,34 @@ Docker Container Plugin for letce2
 """
 
 import argparse
+import contextlib
 import sys
 import os
 import subprocess
-import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import List
 
 from letce2.interface.plugin import Plugin as PluginBase
-from letce2.engine.build import *
 
 
+@contextlib.contextmanager
+def _devnull():
+    """Raw /dev/null descriptor shared by the calls that discard output"""
+    fd = os.open(os.devnull, os.O_RDWR | os.O_CLOEXEC)
+    try:
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def _non_negative_int(value):
+    """argparse type for counts where 0 means unbounded"""
+    count = int(value)
+    if count < 0:
+        raise argparse.ArgumentTypeError(f'{value} is not a non-negative integer')
+    return count
+
 
 class Plugin(PluginBase):
     """Docker container plugin for letce2 experiments"""
@@ -100,6 +117,13 @@ class Plugin(PluginBase):
             default=40,
             help='delay scenario for specified seconds [default: %(default)s].'
         )
+        subparser_start.add_argument(
+            '--init-jobs',
+            type=_non_negative_int,
+            metavar='COUNT',
+            default=0,
+            help='number of nodes to initialize at once, 0 for all [default: %(default)s].'
+        )
         subparser_start.set_defaults(plugin_subcommand='start')
         
         # Stop command - 停止容器
@@ -165,25 +189,28 @@ class Plugin(PluginBase):
             args: Command arguments dict
         """
 
-        match args['plugin_subcommand']:
-            case 'build':
-                self._do_build(args)
-            case 'start':
-                self._do_start(nodes_include,args)
-            case 'stop':
-                self._do_stop(nodes_include,args)
-            case 'clean':
-                self._do_clean(nodes_include,nodes_exclude,args)
-            case _:
-                print(f"❌ Unknown subcommand: {args['plugin_subcommand']}", file=sys.stderr)
-                sys.exit(1)
+        handlers = {
+            'build': lambda: self._do_build(args),
+            'start': lambda: self._do_start(nodes_include, args),
+            'stop': lambda: self._do_stop(nodes_include, args),
+            'clean': lambda: self._do_clean(nodes_include, nodes_exclude, args),
+        }
+
+        handler = handlers.get(args['plugin_subcommand'])
+        if handler is None:
+            print(f"❌ Unknown subcommand: {args['plugin_subcommand']}", file=sys.stderr)
+            sys.exit(1)
+
+        handler()
     
     def _do_build(self, args):
         """Generate experiment configuration files"""
+        from letce2.engine.build import build_configuration
+
         print("🔨 Building Docker experiment configuration...")
         
         # 检查锁文件
-        if os.path.exists(args['lock_file']) and not args['force']:
+        if os.path.lexists(args['lock_file']) and not args['force']:
             print(f"❌ Lock file found: {args['lock_file']}", file=sys.stderr)
             print("   Run `letce2 docker stop` first or use '--force'", file=sys.stderr)
             sys.exit(1)
@@ -203,13 +230,21 @@ class Plugin(PluginBase):
     
     def _do_start(self, nodes, args):
         """Start Docker containers"""
-        print("Starting Docker experiment...")
-        
+        print("Starting Docker experiment...", flush=True)
+
+        cwd = os.getcwd()
+        lock_file = Path(args['lock_file'])
+        compose_file = Path("host/docker-compose.yml")
+
         # check lock file
-        if Path(args['lock_file']).exists() and not args['force']:
+        if os.path.lexists(lock_file) and not args['force']:
             print(f"❌ Lock file found: {args['lock_file']}", file=sys.stderr)
             print("   Run `letce2 docker stop` first or use '--force'", file=sys.stderr)
             sys.exit(1)
+
+        if not compose_file.exists():
+            print(f"⚠️  Docker Compose file not found: {compose_file}", file=sys.stderr)
+            sys.exit(1)
         
         # some process like emane-jammer-simple-service may not start properly
         # if stale pid/log files exist from previous runs, so we clean up persist dir
@@ -218,185 +253,197 @@ class Plugin(PluginBase):
                          '-rf',
                          'persist'])
         
-        for node in nodes:  
-            Path(f'persist/{node}/var/run').mkdir(parents=True, exist_ok=True)
-            Path(f'persist/{node}/var/log').mkdir(parents=True, exist_ok=True)
-            Path(f'persist/{node}/var/tmp').mkdir(parents=True, exist_ok=True)
-        
-        
-        
-        
-        compose_file = Path("host/docker-compose.yml")
-        if compose_file.exists() is False:
-            print(f"⚠️  Docker Compose file not found: {compose_file}", file=sys.stderr)
-            sys.exit(1)
+        # mkdir releases the GIL, so the per-node directories are created concurrently
+        var_dirs = [f'persist/{node}/var/{sub}'
+                    for node in nodes
+                    for sub in ('run', 'log', 'tmp')]
+        if var_dirs:
+            with ThreadPoolExecutor(max_workers=min(32, len(var_dirs))) as executor:
+                list(executor.map(lambda d: os.makedirs(d, exist_ok=True), var_dirs))
 
+        # nodes to initialize, consumed by xargs in start-all
+        nodes_list = Path(cwd, 'persist', 'nodes.list')
+        nodes_list.parent.mkdir(exist_ok=True)
+        nodes_list.write_text(''.join(f'{node}\n' for node in nodes if node != 'host'))
+
+        # compose runs as the invoking user, the same as `docker compose down`
+        # in stop, so both talk to the same docker context
         try:
-            print(f"📦 Starting containers from {compose_file}...")
-            subprocess.run(
-                ['docker', 'compose', '-f', str(compose_file), 'up', '-d'],
-                check=True,
-                capture_output=True,
-                text=True
-            )
-            
-            print("✅ Docker experiment started successfully")
-            print(f"   Use `docker compose -f {compose_file} ps` to check status")
-            
-            Path(args['lock_file']).parent.mkdir(parents=True, exist_ok=True)
-            Path(args['lock_file']).touch()
-            
-            
-                        
-            
+            print(f"📦 Starting containers from {compose_file}...", flush=True)
+            with _devnull() as devnull:
+                subprocess.run(
+                    ['docker', 'compose', '-f', str(compose_file), 'up', '-d'],
+                    check=True,
+                    stdout=devnull,
+                    stderr=subprocess.PIPE
+                )
         except subprocess.CalledProcessError as e:
             print(f"❌ Failed to start containers: {e}", file=sys.stderr)
             if e.stderr:
-                print(e.stderr, file=sys.stderr)
+                print(e.stderr.decode(errors='replace'), file=sys.stderr)
             sys.exit(1)
         except Exception as e:
             print(f"❌ Error: {e}", file=sys.stderr)
             sys.exit(1)
-            
-        # RFC 2822
-        start_utc = time.strftime("%a, %d %b %Y %H:%M:%S +0000",
-                                  time.gmtime(time.time() + args['scenario_delay']))
 
-        # host: build veth links, generate eel and start broker
+        # containers are up, so from here on cleanup is `letce2 docker stop`
         try:
-            subprocess.run(['sudo',
-                             'host/control',
-                             'prestart',
-                             os.getcwd(),
-                             args['environment'],
-                             start_utc])
-
-            subprocess.run(['sudo',
-                             'host/bridge',
-                             'start'])
+            lock_file.touch()
+        except FileNotFoundError:
+            lock_file.parent.mkdir(parents=True, exist_ok=True)
+            lock_file.touch()
 
-            # disable realtime scheduling contraints
-            subprocess.run(['sudo',
-                             'sysctl',
-                             'kernel.sched_rt_runtime_us=-1'])
+        # host services and node init run from a single privileged script.
+        # Experiments whose host templates do not list start-all fall back
+        # to the copy shipped with the plugin
+        start_all = Path('host/start-all')
+        if not start_all.exists():
+            start_all = Path(__file__).parent / 'templates' / 'start-all'
 
+        # stderr is inherited rather than captured: services started by
+        # the host scripts would otherwise hold the pipe open and keep
+        # start waiting for the whole experiment
+        try:
+            print("🚀 Initializing nodes...", flush=True)
             subprocess.run(['sudo',
-                             'host/control',
-                             'start',
-                             os.getcwd(),
-                             args['environment'],
-                             start_utc])
+                            'bash',
+                            str(start_all),
+                            cwd,
+                            args['environment'],
+                            str(args['scenario_delay']),
+                            str(nodes_list),
+                            str(args['init_jobs'])],
+                           check=True)
+        except subprocess.CalledProcessError as e:
+            print(f"❌ Failed to start experiment: {e}", file=sys.stderr)
+            print("   Run `letce2 docker stop` to clean up", file=sys.stderr)
+            sys.exit(1)
         except Exception as e:
             print(f"❌ Error during experiment start: {e}", file=sys.stderr)
             sys.exit(1)
-            
-        print("🚀 Initializing nodes...")
-        for node in nodes:
-            if node == 'host':
-                continue
-            
-            emane_node = f"letce2-{node}"
-            top_dir = "/experiment"
-            env = "" # pre-built into container
-            exec_cmd = [
-                'docker', 'exec', emane_node,
-                'bash', '-c',
-                f"/experiment/{node}/init {top_dir} {node} '{env}' '{start_utc}'"
-            ]
-            subprocess.Popen(exec_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            
-            if Path(f"{node}/biz-init").exists() is False:
-                print(f"ℹ️  Skipping biz-init for {node} (no biz-init script found)")
-                continue
-            
-            biz_node = f"letce2-{node}-biz"
-            exec_cmd = [
-                'docker', 'exec', biz_node,
-                'bash', '-c',
-                f"/experiment/{node}/biz-init {top_dir} {node} '{env}' '{start_utc}'"
-            ]
-            subprocess.Popen(exec_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-        
-    
+
+        print("✅ Docker experiment started successfully")
+        print(f"   Use `docker compose -f {compose_file} ps` to check status")
+
     def _do_stop(self, nodes, args):
         """Stop Docker containers"""
         print("🛑 Stopping Docker experiment...")
         
+        cwd = os.getcwd()
+        lock_file = Path(args['lock_file'])
         compose_file = Path("host/docker-compose.yml")
         
-        if not compose_file.exists():
+        # with --force a missing compose file is left to `docker compose down`
+        if not args['force'] and not compose_file.exists():
             print(f"⚠️  Docker Compose file not found: {compose_file}", file=sys.stderr)
-            if not args['force']:
-                sys.exit(1)
+            sys.exit(1)
         
         try:
-            print("📦 Stopping and removing containers...")
-            subprocess.run(
-                ['docker', 'compose', '-f', str(compose_file), 'down'],
-                check=True,
-                capture_output=True,
-                text=True
-            )
-            
+            print("📦 Stopping and removing containers...", flush=True)
+            with _devnull() as devnull:
+                subprocess.run(
+                    ['docker', 'compose', '-f', str(compose_file), 'down'],
+                    check=True,
+                    stdout=devnull,
+                    stderr=subprocess.PIPE
+                )
             
-            print("✅ Docker experiment stopped successfully")
             
-            # 删除锁文件
-            if Path(args['lock_file']).exists():
-                Path(args['lock_file']).unlink()
+            print("✅ Docker experiment stopped successfully", flush=True)
             
         except subprocess.CalledProcessError as e:
             print(f"❌ Failed to stop containers: {e}", file=sys.stderr)
             if e.stderr:
-                print(e.stderr, file=sys.stderr)
+                print(e.stderr.decode(errors='replace'), file=sys.stderr)
             if not args['force']:
                 sys.exit(1)
         except Exception as e:
             print(f"❌ Error: {e}", file=sys.stderr)
             sys.exit(1)
+
+        # 删除锁文件
+        # a forced stop drops the lock even if compose down failed
+        if os.path.lexists(lock_file):
+            lock_file.unlink()
             
+        # teardown is best-effort: a failing host stop, e.g. a stale pid
+        # file after a crash, must not skip restoring the scheduler limits
+        failed = False
         try:
             # not necessary because docker compose down already stop containers
             # subprocess.run(['sudo',
             #                  'host/bridge',
             #                  'stop'])
             
-            subprocess.run(['sudo',
-                             'host/control',
-                             'stop',
-                             os.getcwd(),
-                             args['environment']])
+            with _devnull() as devnull:
+                subprocess.run(['sudo',
+                                 'host/control',
+                                 'stop',
+                                 cwd,
+                                 args['environment']],
+                               check=True,
+                               stdout=devnull,
+                               stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            print(f"❌ Failed to stop experiment host: {e}", file=sys.stderr)
+            if e.stderr:
+                print(e.stderr.decode(errors='replace'), file=sys.stderr)
+            failed = True
         except Exception as e:
             print(f"❌ Error during experiment stop: {e}", file=sys.stderr)
+            failed = True
+
+        try:
+            with _devnull() as devnull:
+                subprocess.run(['sudo',
+                                 'sysctl',
+                                 'kernel.sched_rt_runtime_us=950000'],
+                               check=True,
+                               stdout=devnull,
+                               stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            print(f"❌ Failed to restore realtime scheduling constraints: {e}", file=sys.stderr)
+            if e.stderr:
+                print(e.stderr.decode(errors='replace'), file=sys.stderr)
+            failed = True
+        except Exception as e:
+            print(f"❌ Error during experiment stop: {e}", file=sys.stderr)
+            failed = True
+
+        if failed:
             sys.exit(1)
-        
-        subprocess.run(['sudo',
-                         'sysctl',
-                         'kernel.sched_rt_runtime_us=950000'])
     
     def _do_clean(self, nodes_include, nodes_exclude, args):
         """Clean up generated files"""
-        print("🧹 Cleaning experiment files...")
-        
+        from letce2.engine.build import clean_configuration, nodes_to_manifest
+
+        print("🧹 Cleaning experiment files...", flush=True)
+
+        lock_file = Path(args['lock_file'])
+        persist_dir = Path('persist')
+
         # 检查锁文件
-        if Path(args['lock_file']).exists() and not args['force']:
+        if os.path.lexists(lock_file) and not args['force']:
             print(f"❌ Lock file found: {args['lock_file']}", file=sys.stderr)
             print("   Run `letce2 docker stop` first or use '--force'", file=sys.stderr)
             sys.exit(1)
         
         if not nodes_exclude:
-            if Path('persist').exists() and Path('persist').is_dir():
+            if persist_dir.is_dir():
                 subprocess.call(['sudo',
                                  'rm',
                                  '-rf',
                                  'persist'])
         else:
-            for node in nodes_include:
-                if Path(f'persist/{node}').exists() and Path(f'persist/{node}').is_dir():
-                    subprocess.call(['sudo',
-                                     'rm',
-                                     '-rf',
-                                     f'persist/{node}'])
+            # remove all node directories with a single privileged rm
+            node_dirs = [str(node_dir)
+                         for node_dir in (persist_dir / node for node in nodes_include)
+                         if node_dir.is_dir()]
+            if node_dirs:
+                subprocess.call(['sudo',
+                                 'rm',
+                                 '-rf',
+                                 *node_dirs])
             nodes_to_manifest(nodes_exclude,
                               args['manifest'])
 